@@ -83,3 +83,11 @@ pause_duration = 5
 pausing_clears_screen = False
 pause_targets = True
 ramp_factors = []
+planned_mitigation_rate = 0.0  # proportion of trials opening with a (seeded) mitigation
+planned_mitigation_types = []  # drawn from uniformly, e.g. ["Audio", "pause"]
+network_sink_address = None  # e.g. ('10.0.0.2', 5151) to stream trials to a CompTrackAggregator
+network_sink_batch_trials = 5
+network_sink_spool_dir = "ExpAssets/Data/spool"  # undelivered batches wait here
+station_id = None  # defaults to this machine's hostname
+max_trials_in_memory = None  # e.g. 10 to spill all but the latest trials' frames to disk; None keeps everything in RAM
+trial_archive_dir = "ExpAssets/Data/trial_archives"
@@ -13,7 +13,11 @@ CREATE TABLE trials (
     block_num integer not null,
     trial_num integer not null,
     timestamp text not null,
-    rt text not null
+    pvt_onset text not null,
+    rt text not null,
+    dropped_frames integer not null,
+    worst_interval text not null,
+    refresh_interval text not null
 );
 
 
@@ -23,12 +27,13 @@ CREATE TABLE frames (
 	trial_num integer not null,
 	block_num integer not null,
 	timestamp text not null,
-	buffeting_force integer not null,
-	additional_force integer not null,
-	net_force integer not null,
 	user_input integer not null,
+	target_position integer not null,
 	displacement integer not null,
-	rt integer not null
+	rt integer not null,
+	flip_start_us integer not null,
+	flip_end_us integer not null,
+	missed_deadline integer not null
 );
 
 CREATE TABLE assessments (
@@ -40,5 +45,11 @@ CREATE TABLE assessments (
 	mean_rt integer not null,
 	lapses integer not null,
 	samples integer not null
-)
+);
+
+CREATE TABLE session_plans (
+	id integer primary key autoincrement not null,
+	participant_id integer not null references participants(id),
+	plan text not null
+);
 
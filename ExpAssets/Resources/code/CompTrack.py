@@ -14,9 +14,11 @@
 #  - presenting alerting signals either randomly or conditionally
 
 from copy import deepcopy
+from collections import OrderedDict
 import abc
 
 import os
+import time
 import numpy as np
 import sdl2
 from klibs.KLCommunication import *
@@ -24,8 +26,8 @@ from klibs.KLConstants import *
 from klibs.KLEnvironment import EnvAgent
 from klibs.KLGraphics.KLDraw import *
 from klibs.KLUtilities import *
-from klibs.KLAudio import AudioClip
-sdl2.SDL_SetRelativeMouseMode(sdl2.SDL_TRUE)
+from CompTrackDynamics import LateFrameDetector, buffeting_force, clamped_step
+# klibs.KLAudio (i.e. SDL_mixer) is only imported once an audio mitigation is configured; see warm_up()
 
 
 
@@ -33,10 +35,9 @@ class CompTrack(EnvAgent):
 	def __init__(self):
 		super(CompTrack, self).__init__()
 		self.__init_time = now()
+		self.startup_times = OrderedDict()  # seconds spent in each start-up stage, see warm_up()
 
-		self.frames = []
-		self.assessments = []
-		self._position = None
+		sdl2.SDL_SetRelativeMouseMode(sdl2.SDL_TRUE)
 
 		#
 		# Define styles & create stimuli
@@ -95,6 +96,28 @@ class CompTrack(EnvAgent):
 			).render()
 		}
 
+		self.__init_state([int(0.5 * self.stim_sizes['cursor']),int(P.screen_x - 0.5 * self.stim_sizes['cursor'])])
+
+		self.startup_times['init'] = now() - self.__init_time
+
+	def __init_state(self, x_bounds):
+		"""
+		Initialises everything but the display (trial data, task & mitigation config, etc.). Split out of __init__() so
+		that headless stand-ins (e.g. benchmarks/bench_comptrack.py) are built from the same state.
+		"""
+		self.clock = now  # time source for rendering; CompTrackReplay substitutes recorded frame timestamps
+
+		self.frames = []  # one list of frames per trial, indexed by trial_index
+		self.assessments = []
+		self.trial_index = -1  # of the current trial, counted across blocks (P.trial_number restarts each block)
+		if P.max_trials_in_memory:
+			# long sessions: keep only recent trials in RAM, spilling older ones to disk (see CompTrackHistory)
+			from CompTrackHistory import TrialFrameHistory, AssessmentHistory
+			archive_dir = os.path.join(P.trial_archive_dir, "p{0}_{1}".format(P.participant_id, int(time.time())))
+			self.frames = TrialFrameHistory(os.path.join(archive_dir, 'frames'), P.max_trials_in_memory)
+			self.assessments = AssessmentHistory(os.path.join(archive_dir, 'assessments'), P.max_trials_in_memory)
+		self._position = None
+
 		# Prepared DB statements
 		self.lapse_query_str = "SELECT COUNT(*) FROM `trials` WHERE `participant_id` = {0} AND `rt` = false AND `trial_num` > {1}"
 		self.mean_rt_query_str = "SELECT SUM(*) FROM `trials` WHERE `participant_id` = {0} AND `rt` != false AND `trial_num` > {1} / {2}"
@@ -103,11 +126,12 @@ class CompTrack(EnvAgent):
 		self.max_input_step = P.max_input_step
 		self.supervise_input = P.supervise_input
 		self.forces = {'buffeting': None, 'additional': None, 'net': None}
+		self.plan = None  # SessionPlan; if set, fixes the buffeting force's phase & origin
 		self.timeout_after = None
 		self.poll_while_moving = P.poll_while_moving
 		self.poll_at_fixation = P.poll_at_fixation
 		self.reset_target_after_poll = P.reset_target_after_poll
-		self.x_bounds = [int(0.5 * self.stim_sizes['cursor']),int(P.screen_x - 0.5 * self.stim_sizes['cursor'])]
+		self.x_bounds = x_bounds
 
 		# performance assessments
 		self.assessment_sample_size = P.assessment_sample_size
@@ -115,19 +139,73 @@ class CompTrack(EnvAgent):
 		self.max_mean_rt = P.max_mean_rt
 		self.excessive_lapse_threshold = P.excessive_lapse_threshold
 		self.__next_trial_start_time = None
+		self.trial_state = None  # CompTrackTrialState of the scheduled trial, see prepare_trial()
+
+		# flip timing telemetry
+		self.late_frames = LateFrameDetector()  # its typical_interval is the running refresh interval estimate
+		self.trial_timing = None  # per-trial aggregates, set by end_trial()
+		self.__reset_trial_timing()
 
 		# mitigations
 		self.audio_warning_file_path = P.audio_warning_file_path
 		self.audio_warning_duration = P.audio_warning_duration
-		self.pause_duration = None
+		self.pause_duration = P.pause_duration
 		self.pausing_clears_screen = P.pausing_clears_screen
 		self.pause_targets = P.pause_targets
 		self.mitigating = False  # only true when a mitigation has run
 		self.current_mitigation = None
+		self.audio_warning = None  # loaded by warm_up()
+
+		# optional streaming of completed trials to a lab aggregator (see CompTrackSink)
+		self.sink = None
+		self.__assessments_sent = 0
+		if P.network_sink_address:
+			import socket
+			from CompTrackSink import NetworkSink
+			self.sink = NetworkSink(P.network_sink_address, P.station_id or socket.gethostname(),
+									P.network_sink_spool_dir, P.network_sink_batch_trials)
+
+		# PVT counter is composed from individually rendered glyphs, see __render_pvt_digits()
+		self.pvt_glyphs = {}
 
 		# set an initial mouse position
 		self.position = P.screen_c[0]
 
+	def warm_up(self):
+		"""
+		Renders every asset, PVT glyph & mitigation resource ahead of the first trial, so that its opening frames don't
+		stutter while they're built on first use. Returns the time taken by each start-up stage.
+		"""
+		stage_start = now()
+		for name, asset in self.assets.items():
+			if isinstance(asset, Drawbject):
+				self.assets[name] = asset.render()
+		stage_start = self.__end_startup_stage('assets', stage_start)
+
+		for glyph in "0123456789.":
+			self.pvt_glyphs[glyph] = message(glyph, 'PVT_digits', flip_screen=False, blit_txt=False)
+		stage_start = self.__end_startup_stage('pvt_glyphs', stage_start)
+
+		if self.audio_warning_file_path:
+			from klibs.KLAudio import AudioClip
+			self.audio_warning = AudioClip(self.audio_warning_file_path)
+		stage_start = self.__end_startup_stage('mitigations', stage_start)
+
+		# first blit of each surface uploads it to the display; do so now, then wipe it before anyone sees
+		fill(self.palette['grue'])
+		for asset in list(self.assets.values()) + list(self.pvt_glyphs.values()):
+			blit(asset, BL_CENTER, P.screen_c)
+		fill(self.palette['grue'])
+		self.__end_startup_stage('display_upload', stage_start)
+
+		return self.startup_times
+
+	def __end_startup_stage(self, stage, stage_start):
+		stage_end = now()
+		self.startup_times[stage] = stage_end - stage_start
+
+		return stage_end
+
 	def assess_performance(self):
 		"""
 		Used to access currently recorded data by variable column
@@ -137,7 +215,7 @@ class CompTrack(EnvAgent):
 			query_data = [P.participant_id, P.trial_number - (1 + self.assessment_sample_size)]
 
 			assessment.lapse_count = self.db.query(self.lapse_query_str.format(*query_data), fetch_all=True)[0][0]
-			assessment.mean_rt = self.db.query(self.mean_rt_query_str.format(*query_data), fetch_all=True)[0]
+			assessment.mean_rt = self.db.query(self.mean_rt_query_str.format(*query_data), fetch_all=True)[0][0]
 			self.assessments.append(assessment)
 
 			if self.assessing['lapses'] and assessment.lapse_count >= self.excessive_lapse_threshold:
@@ -156,31 +234,52 @@ class CompTrack(EnvAgent):
 		 	self.position = P.screen_c[0]
 		self.next_trial_start_time = None
 
+		self.trial_timing = {
+			'dropped_frames': self.__dropped_frames,
+			'worst_interval': self.__worst_interval,
+			'refresh_interval': -1 if self.refresh_interval is None else self.refresh_interval
+		}
+		self.__reset_trial_timing()
+
+		if self.sink:
+			self.sink.push_trial([f.dump() for f in self.frames[self.trial_index]],
+								 [a.dump() for a in self.assessments[self.__assessments_sent:]])
+			self.__assessments_sent = len(self.assessments)
+
+	def prepare_trial(self, onset):
+		"""
+		Readies the coming trial during its ITI: caches its PVT onset & timeout deadlines (see CompTrackTrialState) and
+		creates its frame buffer, so neither is left to the trial's first refresh or the ITI-to-PVT transition.
+		"""
+		self.next_trial_start_time = onset
+
+		# (with P.max_trials_in_memory set, this is also when the oldest trial in memory is archived; the trial being
+		# prepared is always the newest, so is never one of those)
+		self.trial_index += 1
+		while len(self.frames) <= self.trial_index:
+			self.frames.append([])
+
 	def refresh(self, event_queue):
 		# update any mitigations currently in execution
-		try:
+		if self.current_mitigation is not None:
 			self.current_mitigation.update()
-		except AttributeError:
-			pass  # i.e. None
 
 		# start a new frame object to capture all the activity of this refresh
 		self.__new_frame()
+		self.trial_state.update(self.current_frame.timestamp)
 
 		# Compute buffeting forces
 		self.__compute_forces()
 
-		# then iteratively add all force contributions to current position, if they exist on this pass
-		for force in ['net', 'additional', 'buffeting']:
-			try:
-				self.position = self.position  + self.current_frame.forces[force]
-			except TypeError:
-				pass
-
 		# needed for subsequent statements
 		self.__capture_mouse_input(event_queue)
 
-		# set initial position update based on mouse activity
-		self.position = self.position + self.current_frame.user_input
+		# add all force contributions that exist on this pass, then mouse activity, to current position (clamped after
+		# each, as the setter would)
+		forces = self.current_frame.forces
+		self._position = clamped_step(self._position,
+									  [forces['net'], forces['additional'], forces['buffeting'], self.current_frame.user_input],
+									  *self.x_bounds)
 
 		self.__render()
 		self.current_frame.displacement = line_segment_len(P.screen_c, [self.position, P.screen_c[1]])
@@ -188,15 +287,37 @@ class CompTrack(EnvAgent):
 
 
 
+	def render(self):
+		"""
+		Renders the current position & PVT state without advancing forces or input (i.e. for replaying sessions).
+		"""
+		self.trial_state.update(self.clock())
+		self.__render()
+
 	def mitigate(self, m_type):
-		if m_type is "Audio":
-			self.current_mitigation = AudioMitigation(self, self.audio_warning_file_path, self.audio_warning_duration)
+		if m_type == "Audio":
+			self.current_mitigation = AudioMitigation(self, self.audio_warning_file_path, self.audio_warning_duration,
+													  self.audio_warning)
 			self.current_mitigation.run()
 
-		if m_type is "pause":
+		if m_type == "pause":
 			self.current_mitigation = PauseMitigation(self, self.pause_duration, self.pausing_clears_screen, self.pause_targets)
 			self.current_mitigation.run()
 
+	def check_mitigations(self, m_types):
+		"""
+		Raises a ValueError if any of m_types can't be run by mitigate() as configured (e.g. those of a SessionPlan).
+		"""
+		for m_type in m_types:
+			if m_type == "Audio":
+				if not self.audio_warning_file_path or not self.audio_warning_duration:
+					raise ValueError("Audio mitigations require audio_warning_file_path & audio_warning_duration to be set.")
+			elif m_type == "pause":
+				if not self.pause_duration:
+					raise ValueError("Pause mitigations require pause_duration to be set.")
+			else:
+				raise ValueError("Unknown mitigation type '{0}' (expected 'Audio' or 'pause').".format(m_type))
+
 	def excessive_lapse_callback(self):
 		pass
 
@@ -204,7 +325,7 @@ class CompTrack(EnvAgent):
 	def excessive_mean_rt_callback(self):
 		pass
 
-	def __clear_mitigations(self):
+	def clear_mitigations(self):
 		"""
 		This just exists because the mitigation objects can't unset themselves, and only mitigation objects call it.
 		"""
@@ -213,7 +334,7 @@ class CompTrack(EnvAgent):
 
 	def __new_frame(self):
 		try:
-			self.frames[P.trial_number - 1].append(CompTrackFrame(self.exp.current_frame_id, now()))
+			self.frames[self.trial_index].append(CompTrackFrame(self.exp.current_frame_id, now()))
 		except IndexError:
 			self.frames.append([])
 			self.__new_frame()
@@ -227,26 +348,25 @@ class CompTrack(EnvAgent):
 		if debug_this: print "\n\n>>> __render() >>>"
 
 		# if pausing everything, just don't ever blit or flip, EZ
-		if self.mitigating and self.current_mitigation.mitigation_type is "pause" and self.current_mitigation.include_targets:
+		if self.mitigating and self.current_mitigation.mitigation_type == "pause" and self.current_mitigation.include_targets:
 			return
 
 		# Paint & populate display
 		fill(self.palette['grue'])
 
 		# if in a screen-clearing mitigation, just flip after the fill
-		if self.mitigating and self.current_mitigation.mitigation_type is "pause" and self.current_mitigation.clear_screen:
-			flip()
+		if self.mitigating and self.current_mitigation.mitigation_type == "pause" and self.current_mitigation.clear_screen:
+			self.__flip()
 			return
 
 		# Spawn & blit PVT display (if PVT event; is None if between events and positive during ITIs)
-		if self.time_until_next_trial is 0:
+		if self.trial_state.pvt_active:
 			# Digit string represents milliseconds elapsed since PVT onset
-			digit_str = str((now() - self.next_trial_start_time) * 1000)[0:4]
+			digit_str = str((self.clock() - self.next_trial_start_time) * 1000)[0:4]
 			if digit_str[-1] == ".":
 				digit_str = digit_str[0:3]
-			digits = message(digit_str, 'PVT_digits', flip_screen=False, blit_txt=False)
 			blit(self.assets['PVT_frame'], BL_CENTER, P.screen_c)
-			blit(digits, BL_CENTER, P.screen_c)
+			self.__render_pvt_digits(digit_str)
 		# Otherwise, blit cursor to updated position
 		else:
 			blit(self.assets['fixation'], BL_CENTER, P.screen_c)
@@ -256,25 +376,63 @@ class CompTrack(EnvAgent):
 			blit(self.assets['cursor'], BL_CENTER, [self.position, P.screen_c[1]])
 
 		# Present display
-		flip()
+		self.__flip()
 
 		if debug_this: print "\n<<< __render() <<<"
 
-	def __buffeting_force(self):
+	def __flip(self):
 		"""
-		Generates variable buffeting force
-		Force equals sum of several sinusoidal functions
+		Presents the display, recording when the current frame's flip began & ended and whether it missed its deadline.
+		"""
+		try:
+			frame = self.current_frame
+		except IndexError:
+			flip()  # i.e. rendering outside of a trial (see render()), so there's no frame to record to
+			return
 
-		Note: when modifying these values
+		frame.flip_start = now()
+		flip()
+		frame.flip_end = now()
+
+		if self.__last_flip_end is not None:
+			interval = frame.flip_end - self.__last_flip_end
+			if self.late_frames.is_late(interval):
+				frame.missed_deadline = True
+				self.__dropped_frames += 1
+			self.__worst_interval = max(self.__worst_interval, interval)
+		self.__last_flip_end = frame.flip_end
+
+	def __reset_trial_timing(self):
+		# the gap between trials (assessment, DB queries, etc.) isn't a dropped frame, so intervals restart each trial
+		self.__last_flip_end = None
+		self.__dropped_frames = 0
+		self.__worst_interval = -1
+
+	def __render_pvt_digits(self, digit_str):
+		"""
+		Blits digit_str centre-screen from cached glyphs, rendering (and caching) any not yet seen.
+		"""
+		glyphs = []
+		for char in digit_str:
+			try:
+				glyphs.append(self.pvt_glyphs[char])
+			except KeyError:
+				self.pvt_glyphs[char] = message(char, 'PVT_digits', flip_screen=False, blit_txt=False)
+				glyphs.append(self.pvt_glyphs[char])
 
-		value in "sin( val * timestamp)" modifies periodicity of sin wave, but not amplitude
-		i.e., how long to reach min/max amplitude, lower vals mean wider/longer periods
+		x = P.screen_c[0] - sum(g.width for g in glyphs) // 2
+		for g in glyphs:
+			blit(g, BL_LEFT, [x, P.screen_c[1]])
+			x += g.width
 
-		value in "val * sin(timestamp)" modifies amplitude of sin wave, but not periodicity
-		i.e., scales resultant displacement value applied to cursor.
+	def __buffeting_force(self):
 		"""
-		t = self.current_frame.timestamp
-		return sin(t) + sin(0.3 * t) + sin(0.5 * t) + sin(0.7 * t) - sin(0.9 * t)
+		Generates variable buffeting force for the current frame (see CompTrackDynamics.buffeting_force)
+		"""
+		if self.plan:
+			return self.plan.buffeting_force(self.current_frame.timestamp)
+
+		return buffeting_force(self.current_frame.timestamp)
 
 	def __compute_buffet_modifier_values(self, start=0.1, stop=1.4, count=100):
 		"""
@@ -303,8 +461,8 @@ class CompTrack(EnvAgent):
 			self.forces['additional'] = None
 		self.forces['net'] = self.forces['buffeting']
 
-		# update current frame
-		self.current_frame.forces = self.forces
+		# update current frame (copied, else every frame would share, and dump, the latest forces)
+		self.current_frame.forces = dict(self.forces)
 
 
 	def __capture_mouse_input(self, event_queue):
@@ -313,7 +471,7 @@ class CompTrack(EnvAgent):
 		"""
 
 		# print "\n\n >>> __capture_mouse_input() >>>"
-		if self.mitigating and self.current_mitigation.mitigation_type is "pause":
+		if self.mitigating and self.current_mitigation.mitigation_type == "pause":
 			return
 
 		for event in event_queue:
@@ -353,13 +511,7 @@ class CompTrack(EnvAgent):
 		"""
 		Set position of cursor, censors values which would place the cursor off screen
 		"""
-		if int(val) not in range(*self.x_bounds):
-			if val < self.x_bounds[0]:
-				val = self.x_bounds[0]
-			else:
-				val = self.x_bounds[1]
-
-		self._position = val
+		self._position = min(max(val, self.x_bounds[0]), self.x_bounds[1])
 
 	@property
 	def next_trial_start_time(self):
@@ -368,23 +520,40 @@ class CompTrack(EnvAgent):
 	@next_trial_start_time.setter
 	def next_trial_start_time(self, val):
 		self.__next_trial_start_time = val
+		self.trial_state = None if val is None else CompTrackTrialState(val, self.timeout_after)
 
 	@property
-	def time_until_next_trial(self):
-		# if the value is None, we are between trials
-		if self.__next_trial_start_time is None:
-			raise ValueError('No trial scheduled')
-
-		# if the value is zero, a PVT is currently active
-		if now() > self.__next_trial_start_time:
-			return 0
-
-		# else, just give the actual value
-		return self.__next_trial_start_time - now()
+	def refresh_interval(self):
+		# running estimate (s), from frames that made their deadline
+		return self.late_frames.typical_interval
 
 	@property
 	def current_frame(self):
-		return self.frames[P.trial_number - 1][-1]
+		return self.frames[self.trial_index][-1]
+
+
+class CompTrackTrialState(object):
+	"""
+	Tracks a scheduled trial through its ITI, PVT & completion. Both deadlines are fixed when the trial is scheduled, so
+	each refresh need only compare the frame's timestamp to the next one. The PVT remains active through the trial's
+	final frame, i.e. the one that completes it.
+	"""
+	def __init__(self, onset, timeout):
+		self.onset = onset
+		self.timeout_at = onset + timeout if timeout is not None else float('inf')
+		self.deadline = onset  # of the next transition
+		self.pvt_active = False
+		self.complete = False
+
+	def update(self, t):
+		if t < self.deadline:
+			return
+		self.pvt_active = True
+		if t >= self.timeout_at:
+			self.complete = True
+			self.deadline = float('inf')
+		else:
+			self.deadline = self.timeout_at
 
 
 class CompTrackFrame(EnvAgent):
@@ -400,14 +569,17 @@ class CompTrackFrame(EnvAgent):
 		self.rt = -1
 		self.forces = {'buffeting': -1, 'additional': -1, 'net': -1}
 		self.target_position = -1  # note: at end, i.e, post forces & input
-
+		self.flip_start = None  # None if the frame wasn't flipped (i.e. paused)
+		self.flip_end = None
+		self.missed_deadline = False
 
 	def dump(self, verbose=False):
+		# forces aren't stored; they can be regenerated from the timestamp & session plan (see CompTrackPlan)
 		data = [P.participant_id, self.block_number, self.trial_number, self.timestamp,
-				self.forces['buffeting'], self.forces['additional'], self.forces['net'],
-				self.user_input, self.target_position, self.displacement, self.rt]
-		labels = ['participant_id','block_num', 'trial_num', 'timestamp', 'buffeting_force', 'additional_force', 'net_force',
-				  'user_input', 'target_position','displacement', 'rt']
+				self.user_input, self.target_position, self.displacement, self.rt,
+				self.__since_timestamp_us(self.flip_start), self.__since_timestamp_us(self.flip_end), int(self.missed_deadline)]
+		labels = ['participant_id','block_num', 'trial_num', 'timestamp', 'user_input', 'target_position',
+				  'displacement', 'rt', 'flip_start_us', 'flip_end_us', 'missed_deadline']
 		if verbose:
 			dump_str = ''
 			for i in range(0, len(labels)):
@@ -417,6 +589,10 @@ class CompTrackFrame(EnvAgent):
 
 		return {labels[i]:data[i] for i in range(0, len(labels))}
 
+	def __since_timestamp_us(self, t):
+		# flip times are stored as whole microseconds after the frame's timestamp, for compactness
+		return -1 if t is None else int(round((t - self.timestamp) * 1e6))
+
 	@property
 	def timestamp(self):
 		return float(self.__timestamp)
@@ -460,18 +636,19 @@ class CompTrackMitigation(EnvAgent):
 
 
 class AudioMitigation(CompTrackMitigation):
-	def __init__(self, comp_track, tone_file_path, duration):
+	def __init__(self, comp_track, tone_file_path, duration, tone=None):
 		super(AudioMitigation, self).__init__()
 		self.comp_track = comp_track
-		self.tone = AudioClip(tone_file_path)
+		if tone is None:  # i.e. not preloaded by CompTrack.warm_up()
+			from klibs.KLAudio import AudioClip
+			tone = AudioClip(tone_file_path)
+		self.tone = tone
 		self.duration = duration
 		self.mitigation_type = "audio"
 
 	def run(self):
-		try:
+		if self.message:
 			self.message()
-		except AttributeError:
-			pass
 		self.comp_track.mitigating = True
 		self.tone.play()
 		self.ends_at = now() + self.duration
@@ -484,30 +661,29 @@ class AudioMitigation(CompTrackMitigation):
 		if now() < self.ends_at:
 			return
 		self.tone.stop()
-		self.comp_track.__clear_mitigations()
+		self.comp_track.clear_mitigations()
 
 class PauseMitigation(CompTrackMitigation):
 	def __init__(self, comp_track, duration, clear_screen, pause_target=False):
 		super(PauseMitigation, self).__init__()
 		self.comp_track = comp_track
 		self.duration = duration
-		self.include_target = pause_target
+		self.include_targets = pause_target
 		self.mitigation_type = "pause"
 		self.clear_screen = clear_screen
 		self.ends_at = None
 
 
 	def run(self):
-		try:
+		if self.message:
 			self.message()
-		except AttributeError:
-			pass
+		self.comp_track.mitigating = True
 		self.ends_at = now() + self.duration
 
 	def update(self):
 		if now() < self.ends_at:
 			return
-		self.comp_track.__clear_mitigations()
+		self.comp_track.clear_mitigations()
 
 
 class RampMitigation(CompTrackMitigation):
@@ -523,10 +699,8 @@ class RampMitigation(CompTrackMitigation):
 
 	def run(self):
 		self.onset = now()
-		try:
+		if self.message:
 			self.message()
-		except AttributeError:
-			pass
 		# save a copy of initial value so they an be restored
 		for f in self.factors_cfg:
 			f_name = f['factor']
@@ -547,7 +721,7 @@ class RampMitigation(CompTrackMitigation):
 					self.comp_track[f_name] =  progression * goal_diff
 			return
 
-		self.comp_track.__clear_mitigations()
+		self.comp_track.clear_mitigations()
 
 	@property
 	def elapsed(self):
@@ -0,0 +1,121 @@
+# CompTrackAggregator.py
+# Collects batches from stations' NetworkSinks into one central SQLite store.
+
+# Run on the lab server (or localhost, for testing):
+#   python CompTrackAggregator.py central.db --host 0.0.0.0 --port 5151
+#
+# Rows keep their station's identifiers alongside a `station` column, as each
+# station's participant_ids are only unique locally. Every batch is written
+# with bulk inserts in a single transaction, and recorded by id so that a batch
+# re-sent after a lost acknowledgement isn't stored twice. An assessment holding
+# values SQLite can't bind is logged & skipped, so it can't cost the batch its
+# frames; a batch that can't be stored at all (i.e. malformed) is rolled back and
+# rejected, so its station sets it aside rather than re-sending it indefinitely.
+
+import sqlite3
+import sys
+import threading
+import zlib
+
+try:
+	import socketserver
+except ImportError:  # python 2
+	import SocketServer as socketserver
+
+from CompTrackSink import ACK, ASSESSMENT_COLS, FRAME_COLS, REJECT, decode_batch, recv_message
+
+
+def _create_table_sql(table, cols):
+	return "CREATE TABLE IF NOT EXISTS `{0}` (id integer primary key autoincrement not null, station text not null, {1})".format(
+		table, ", ".join("`{0}`".format(c) for c in cols))
+
+
+def _insert_sql(table, cols):
+	return "INSERT INTO `{0}` (`station`, {1}) VALUES (?, {2})".format(
+		table, ", ".join("`{0}`".format(c) for c in cols), ", ".join("?" * len(cols)))
+
+
+class CentralStore(object):
+
+	def __init__(self, db_path):
+		self.db_path = db_path
+		self.lock = threading.Lock()
+		self.con = sqlite3.connect(db_path, check_same_thread=False)
+		with self.con:
+			self.con.execute(_create_table_sql('frames', FRAME_COLS))
+			self.con.execute(_create_table_sql('assessments', ASSESSMENT_COLS))
+			self.con.execute("CREATE TABLE IF NOT EXISTS `batches` (batch_id text primary key not null, station text not null)")
+		self.frames_sql = _insert_sql('frames', FRAME_COLS)
+		self.assessments_sql = _insert_sql('assessments', ASSESSMENT_COLS)
+
+	def store(self, batch):
+		"""
+		Writes a decoded batch; returns False if it had already been stored.
+		"""
+		station = batch['station']
+		with self.lock:
+			with self.con:
+				try:
+					self.con.execute("INSERT INTO `batches` VALUES (?, ?)", (batch['batch_id'], station))
+				except sqlite3.IntegrityError:
+					return False
+				self.con.executemany(self.frames_sql, ([station] + row for row in batch['frames']))
+				self.__store_assessments(station, batch['assessments'])
+
+		return True
+
+	def __store_assessments(self, station, assessments):
+		for row in assessments:
+			if len(row) != len(ASSESSMENT_COLS):
+				raise ValueError("Malformed assessment: {0!r}".format(row))
+			try:
+				self.con.execute(self.assessments_sql, [station] + row)
+			except (sqlite3.InterfaceError, sqlite3.ProgrammingError) as e:
+				sys.stderr.write("Skipped assessment from {0} ({1!r}): {2!r}\n".format(station, e, row))
+
+	def close(self):
+		self.con.close()
+
+
+class BatchHandler(socketserver.BaseRequestHandler):
+
+	def handle(self):
+		message = recv_message(self.request)
+		try:
+			self.server.store.store(decode_batch(message))
+		except (zlib.error, ValueError, KeyError, TypeError, sqlite3.Error) as e:
+			sys.stderr.write("Rejected batch from {0}: {1!r}\n".format(self.client_address[0], e))
+			self.request.sendall(REJECT)
+			return
+		self.request.sendall(ACK)
+
+
+class Aggregator(socketserver.ThreadingMixIn, socketserver.TCPServer):
+	allow_reuse_address = True
+	daemon_threads = True
+
+	def __init__(self, db_path, host='127.0.0.1', port=5151):
+		self.store = CentralStore(db_path)
+		socketserver.TCPServer.__init__(self, (host, port), BatchHandler)
+
+	def server_close(self):
+		socketserver.TCPServer.server_close(self)
+		self.store.close()
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Collect CompTrack station data into a central database.")
+	parser.add_argument('db_path')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=5151)
+	args = parser.parse_args()
+
+	server = Aggregator(args.db_path, args.host, args.port)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
@@ -0,0 +1,105 @@
+# CompTrackDynamics.py
+# Cursor physics shared by CompTrack and the offline tools (replay, simulation).
+
+# Kept free of klibs & SDL so that it can be imported outside of a running
+# experiment; every function accepts either scalars or numpy arrays.
+
+import numpy as np
+
+
+# a frame interval over LATE_FRAME_FACTOR typical intervals is late (i.e. missed a vsync); the typical interval is
+# an exponential average, weighted by ON_TIME_WEIGHT, of on-time intervals
+LATE_FRAME_FACTOR = 1.5
+ON_TIME_WEIGHT = 0.05
+
+# periodicity of each sinusoidal component of the buffeting force, and its sign
+BUFFETING_TERMS = [(1.0, 1), (0.3, 1), (0.5, 1), (0.7, 1), (0.9, -1)]
+NO_PHASE_OFFSETS = [0.0] * len(BUFFETING_TERMS)
+
+
+def buffeting_force(t, phase_offsets=NO_PHASE_OFFSETS):
+	"""
+	Generates variable buffeting force at time t (s)
+	Force equals sum of several sinusoidal functions, each shifted by its phase offset (radians)
+
+	Note: when modifying these values
+
+	value in "sin( val * timestamp)" modifies periodicity of sin wave, but not amplitude
+	i.e., how long to reach min/max amplitude, lower vals mean wider/longer periods
+
+	value in "val * sin(timestamp)" modifies amplitude of sin wave, but not periodicity
+	i.e., scales resultant displacement value applied to cursor.
+	"""
+	force = 0.0
+	for (periodicity, sign), phase in zip(BUFFETING_TERMS, phase_offsets):
+		force = force + sign * np.sin(periodicity * t + phase)
+
+	return force
+
+
+class LateFrameDetector(object):
+	"""
+	Flags frame intervals longer than late_factor times the typical interval. Only on-time intervals update the
+	typical interval, so a run of late frames can't raise the bar. Shared by CompTrack's live missed_deadline flags
+	and CompTrackReplay's late_frame divergences, so the two agree.
+	"""
+	def __init__(self, late_factor=LATE_FRAME_FACTOR, weight=ON_TIME_WEIGHT):
+		self.late_factor = late_factor
+		self.weight = weight
+		self.typical_interval = None
+
+	def is_late(self, interval):
+		"""
+		Returns True if interval is late; otherwise folds it into the typical interval and returns False.
+		"""
+		if self.typical_interval is not None and interval > self.late_factor * self.typical_interval:
+			return True
+		if self.typical_interval is None:
+			self.typical_interval = interval
+		else:
+			self.typical_interval = (1 - self.weight) * self.typical_interval + self.weight * interval
+
+		return False
+
+
+def clamped_step(position, steps, lo, hi):
+	"""
+	Moves position by each of steps in turn (skipping any that are None), clamping it to [lo, hi] after each, as
+	CompTrack.refresh() applies a frame's forces & input. Scalars only; see clamped_walk() for arrays.
+	"""
+	for step in steps:
+		if step is not None:
+			position = min(max(position + step, lo), hi)
+
+	return position
+
+
+def clamped_walk(position, steps, lo, hi):
+	"""
+	Returns every position reached by moving position by each of steps (along its first axis) in turn, clamping to
+	[lo, hi] after each; i.e. clamped_step() for a whole run of steps in one pass of array operations.
+
+	Each step is the map x -> clip(x + a, l, h), and any run of such maps composes into another of the same form:
+	clip(clip(x + a1, l1, h1) + a2, l2, h2) == clip(x + a1 + a2, clip(l1 + a2, l2, h2), clip(h1 + a2, l2, h2)).
+	The maps for every prefix of steps are thus found with a parallel (Hillis-Steele) scan, in log2(len(steps))
+	passes, rather than one step at a time. Trailing axes broadcast, e.g. one column per simulated configuration.
+	"""
+	a = np.array(steps, dtype=float)
+	l = np.empty_like(a)
+	h = np.empty_like(a)
+	l[...] = lo
+	h[...] = hi
+
+	offset = 1
+	while offset < len(a):
+		# compose each map with the one spanning the steps preceding it
+		a2, l2, h2 = a[offset:], l[offset:], h[offset:]
+		l1, h1 = l[:-offset], h[:-offset]
+		composed_l = np.minimum(np.maximum(l1 + a2, l2), h2)
+		composed_h = np.minimum(np.maximum(h1 + a2, l2), h2)
+		a[offset:] = a[:-offset] + a2
+		l[offset:] = composed_l
+		h[offset:] = composed_h
+		offset *= 2
+
+	return np.minimum(np.maximum(position + a, l), h)
@@ -0,0 +1,160 @@
+# CompTrackHistory.py
+# Bounded-memory stand-ins for CompTrack.frames & CompTrack.assessments.
+
+# Both behave as lists (append, len, indexing, slicing, iteration) but keep
+# only the most recent max_in_memory entries in RAM; older entries are spilled
+# to one small gzipped JSON archive apiece and loaded back, on demand, if
+# accessed. Spilled entries come back as Archived* objects whose dump() returns
+# what the original's did, and whose attributes read as the original's did;
+# only what dump() records is archived, so a frame's id & forces are not (the
+# forces can be regenerated from the session plan, see CompTrackPlan), and its
+# flip times are kept to the microsecond.
+
+import abc
+import gzip
+import json
+import os
+import shutil
+
+
+# CompTrackFrame attributes stored under another dump() label
+FRAME_LABELS = {'trial_number': 'trial_num', 'block_number': 'block_num'}
+# CompTrackAssessment.dump()'s sequence
+ASSESSMENT_FIELDS = ['participant_id', 'trial_number', 'block_number', 'timestamp', 'mean_rt', 'lapses', 'samples']
+
+
+class ArchivedFrame(object):
+	__slots__ = ['data']
+
+	def __init__(self, data):
+		self.data = data
+
+	def dump(self, verbose=False):
+		if verbose:
+			return "".join("{0}: {1} |\t".format(label, self.data[label]) for label in self.data)
+
+		return dict(self.data)
+
+	def __getattr__(self, name):
+		if name in ('flip_start', 'flip_end'):
+			offset = self.data[name + '_us']
+			return None if offset == -1 else self.data['timestamp'] + offset / 1e6
+		if name == 'missed_deadline':
+			return bool(self.data[name])
+		try:
+			return self.data[FRAME_LABELS.get(name, name)]
+		except KeyError:
+			raise AttributeError(name)
+
+
+class ArchivedAssessment(object):
+	__slots__ = ['data']
+
+	def __init__(self, data):
+		self.data = data
+
+	def dump(self):
+		return list(self.data)
+
+	def __getattr__(self, name):
+		try:
+			return self.data[ASSESSMENT_FIELDS.index(name)]
+		except ValueError:
+			raise AttributeError(name)
+
+
+class BoundedHistory(object):
+	"""
+	List of entries of which at most max_in_memory (the most recent) are held in memory, the rest in archive_dir.
+	"""
+	__metaclass__ = abc.ABCMeta
+	archive_prefix = 'entry'
+
+	def __init__(self, archive_dir, max_in_memory):
+		if max_in_memory < 1:
+			raise ValueError("At least one entry must be held in memory.")
+		self.archive_dir = archive_dir
+		self.max_in_memory = max_in_memory
+		self.__entries = {}  # index: entry, for those in memory
+		self.__count = 0
+
+		if not os.path.isdir(archive_dir):
+			os.makedirs(archive_dir)
+
+	def append(self, entry):
+		self.__entries[self.__count] = entry
+		self.__count += 1
+
+		# only the entry leaving memory is written, so each is archived once, when it's (presumably) complete
+		oldest = self.__count - 1 - self.max_in_memory
+		if oldest in self.__entries:
+			with gzip.open(self.__archive_path(oldest), 'wb') as f:
+				f.write(json.dumps(self._pack(self.__entries.pop(oldest)), separators=(',', ':')).encode('utf-8'))
+
+	def __len__(self):
+		return self.__count
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(self.__count))]
+		if index < 0:
+			index += self.__count
+		if not 0 <= index < self.__count:
+			raise IndexError("history index out of range")
+		try:
+			return self.__entries[index]
+		except KeyError:
+			with gzip.open(self.__archive_path(index), 'rb') as f:
+				return self._unpack(json.loads(f.read().decode('utf-8')))
+
+	def __iter__(self):
+		# archives are loaded one at a time, so iterating costs no more memory than the largest entry
+		for i in range(self.__count):
+			yield self[i]
+
+	def discard(self):
+		"""
+		Deletes the archives (i.e. once their contents have been saved elsewhere).
+		"""
+		shutil.rmtree(self.archive_dir, ignore_errors=True)
+
+	@abc.abstractmethod
+	def _pack(self, entry):
+		pass
+
+	@abc.abstractmethod
+	def _unpack(self, data):
+		pass
+
+	def __archive_path(self, index):
+		return os.path.join(self.archive_dir, "{0}_{1}.json.gz".format(self.archive_prefix, index))
+
+
+class TrialFrameHistory(BoundedHistory):
+	"""
+	CompTrack.frames: one entry per trial, each a list of that trial's frames.
+	"""
+	archive_prefix = 'trial'
+
+	def _pack(self, frames):
+		rows = [f.dump() for f in frames]
+		labels = sorted(rows[0]) if rows else []
+
+		return {'labels': labels, 'rows': [[row[label] for label in labels] for row in rows]}
+
+	def _unpack(self, data):
+		# a tuple, so that appending to an archived trial fails rather than being silently lost
+		return tuple(ArchivedFrame(dict(zip(data['labels'], row))) for row in data['rows'])
+
+
+class AssessmentHistory(BoundedHistory):
+	"""
+	CompTrack.assessments: one entry per CompTrackAssessment.
+	"""
+	archive_prefix = 'assessment'
+
+	def _pack(self, assessment):
+		return assessment.dump()
+
+	def _unpack(self, data):
+		return ArchivedAssessment(data)
@@ -0,0 +1,119 @@
+# CompTrackPlan.py
+# Seeded plan of everything a session presents that isn't down to the participant.
+
+# From one seed, the plan fixes the ITI sequence, the phase offsets of the
+# buffeting force's components and which trials open with a mitigation. Only
+# the seed, the session's start time and the parameters the plan depends on are
+# stored (see encode()), from which offline tools can regenerate the exact
+# stimulus, e.g. the buffeting force of any frame from its timestamp alone.
+# Regenerate under the Python major version the session ran under, as
+# random.Random's integer draws differ between 2 & 3.
+
+import json
+import math
+import random
+import sqlite3
+
+import numpy as np
+
+from CompTrackDynamics import BUFFETING_TERMS, buffeting_force, clamped_walk
+
+PLAN_VERSION = 1
+
+
+def generate_itis(rng, trial_count, iti, pvt_timeout, experiment_duration):
+	"""
+	Returns trial_count whole-second ITIs within [iti[0], iti[1]] which, together, fill experiment_duration.
+	"""
+	expected_duration = (0.5 * trial_count * pvt_timeout) + (trial_count * sum(iti) * 0.5)
+
+	if expected_duration > experiment_duration:
+		raise ValueError("It is unlikely this number of trials, of the proposed ITIs, can be completed in the allotted time.")
+
+	# start with a uniform block of minimum itis
+	itis = trial_count * [iti[0]]
+
+	surplus = experiment_duration - sum(itis)
+
+	if surplus > trial_count * (iti[1] - iti[0]):
+		raise ValueError("This experiment duration cannot be met with this trial count/ITI combination.")
+	while surplus > 0:
+		index = rng.randint(0, len(itis) - 1)
+		if itis[index] < iti[1]:
+			itis[index] += 1
+			surplus -= 1
+
+	return itis
+
+
+class SessionPlan(object):
+	"""
+	Derives a session's ITIs, buffeting phase offsets & planned mitigations from seed. origin is the session's start
+	time, against which the buffeting force is timed.
+	"""
+	def __init__(self, seed, origin, trial_count, iti, pvt_timeout, experiment_duration, x_bounds,
+				 mitigation_rate=0.0, mitigation_types=()):
+		self.seed = seed
+		self.origin = origin
+		self.params = {
+			'trial_count': trial_count,
+			'iti': list(iti),
+			'pvt_timeout': pvt_timeout,
+			'experiment_duration': experiment_duration,
+			'x_bounds': list(x_bounds),
+			'mitigation_rate': mitigation_rate,
+			'mitigation_types': list(mitigation_types)
+		}
+
+		# draw order is part of the plan's definition: changing it changes every session's stimulus, so bump
+		# PLAN_VERSION if it must change
+		rng = random.Random(seed)
+		self.itis = generate_itis(rng, trial_count, iti, pvt_timeout, experiment_duration)
+		self.phase_offsets = [rng.uniform(0, 2 * math.pi) for term in BUFFETING_TERMS]
+		self.mitigations = {}  # trial index (from 0, across blocks): mitigation type
+		for trial in range(trial_count):
+			if mitigation_types and rng.random() < mitigation_rate:
+				self.mitigations[trial] = rng.choice(mitigation_types)
+
+	def buffeting_force(self, timestamp):
+		"""
+		Buffeting force at timestamp(s), as presented during this session.
+		"""
+		return buffeting_force(np.asarray(timestamp, dtype=float) - self.origin, self.phase_offsets)
+
+	def positions(self, start_position, timestamps, user_inputs):
+		"""
+		Regenerates a trial's target positions from its first position & each frame's timestamp & recorded input.
+		"""
+		force = self.buffeting_force(timestamps)
+		# per frame, in CompTrack.refresh()'s order: 'net' & 'buffeting' forces (equal), then input
+		steps = np.column_stack([force, force, np.asarray(user_inputs, dtype=float)]).ravel()
+
+		return clamped_walk(start_position, steps, *self.params['x_bounds'])[2::3]
+
+	def encode(self):
+		return json.dumps({'version': PLAN_VERSION, 'seed': self.seed, 'origin': self.origin, 'params': self.params},
+						  separators=(',', ':'), sort_keys=True)
+
+	@classmethod
+	def decode(cls, encoded):
+		data = json.loads(encoded)
+		if data['version'] != PLAN_VERSION:
+			raise ValueError("Session plan version {0} can't be regenerated by version {1}.".format(
+				data['version'], PLAN_VERSION))
+
+		return cls(data['seed'], data['origin'], **data['params'])
+
+	@classmethod
+	def from_db(cls, db_path, participant_id):
+		"""
+		Regenerates a participant's plan from the `session_plans` table, or returns None if none was stored.
+		"""
+		con = sqlite3.connect(db_path)
+		try:
+			row = con.execute("SELECT `plan` FROM `session_plans` WHERE `participant_id` = ?",
+							  (participant_id,)).fetchone()
+		finally:
+			con.close()
+
+		return None if row is None else cls.decode(row[0])
@@ -0,0 +1,188 @@
+# CompTrackReplay.py
+# Re-presents a session recorded to the `frames` table, for QA & participant review.
+
+# Frames are streamed from the database in batches, never loaded whole. Given a
+# CompTrack instance, each frame is re-drawn through CompTrack's own renderer
+# (cursor at the recorded target_position, PVT counter running from the recorded
+# onset); without one, the session is stepped through headlessly. Either way,
+# frames whose timing diverged from the cursor physics are reported.
+
+import sqlite3
+import time
+from collections import namedtuple
+
+from CompTrackDynamics import LATE_FRAME_FACTOR, LateFrameDetector, clamped_step
+from CompTrackPlan import SessionPlan
+
+REPLAY_SPEEDS = (1, 4, 16)
+
+FRAME_COLS = ['id', 'block_num', 'trial_num', 'timestamp', 'user_input', 'target_position', 'displacement', 'rt']
+ReplayFrame = namedtuple('ReplayFrame', FRAME_COLS)
+
+# kind is one of 'late_frame' (interval well beyond the typical refresh) or 'physics' (recorded target_position isn't
+# where the session plan's forces & the recorded input should have put it; value is the error in px)
+Divergence = namedtuple('Divergence', ['frame_id', 'block_num', 'trial_num', 'kind', 'value'])
+
+
+class FrameStream(object):
+	"""
+	Lazily iterates a participant's frames in recording order, fetching batch_size rows per query round-trip.
+	"""
+	def __init__(self, db_path, participant_id, block_num=1, trial_num=1, batch_size=512):
+		self.db_path = db_path
+		self.participant_id = participant_id
+		self.block_num = block_num
+		self.trial_num = trial_num
+		self.batch_size = batch_size
+
+	def __iter__(self):
+		query = ("SELECT {0} FROM `frames` WHERE `participant_id` = ? AND "
+				 "(`block_num` > ? OR (`block_num` = ? AND `trial_num` >= ?)) ORDER BY `id`").format(
+			", ".join("`{0}`".format(c) for c in FRAME_COLS))
+		con = sqlite3.connect(self.db_path)
+		try:
+			# participant_id is a text column in `frames`
+			cursor = con.execute(query, (str(self.participant_id), self.block_num, self.block_num, self.trial_num))
+			while True:
+				rows = cursor.fetchmany(self.batch_size)
+				if not rows:
+					break
+				for row in rows:
+					# timestamps are stored as text
+					yield ReplayFrame._make(row[:3] + (float(row[3]),) + row[4:])
+		finally:
+			con.close()
+
+
+class SessionReplay(object):
+	"""
+	Plays back a recorded session at speed x real-time, optionally through a CompTrack instance's renderer.
+	"""
+	def __init__(self, db_path, participant_id, speed=1, comp_track=None, paced=None, late_factor=LATE_FRAME_FACTOR,
+				 position_tolerance=1e-3):
+		if speed <= 0:
+			raise ValueError("Replay speed must be positive (typically one of {0}).".format(REPLAY_SPEEDS))
+		self.db_path = db_path
+		self.participant_id = participant_id
+		self.speed = speed
+		self.comp_track = comp_track
+		self.paced = comp_track is not None if paced is None else paced  # headless replays run flat-out by default
+		self.late_factor = late_factor  # multiple of the typical frame interval beyond which a frame is 'late'
+		self.position_tolerance = position_tolerance
+		self.divergences = []
+		self.__stream = FrameStream(db_path, participant_id)
+		self.__onsets = None
+		self.__timestamp = None
+
+		try:
+			self.plan = SessionPlan.from_db(db_path, participant_id)
+		except sqlite3.OperationalError:
+			self.plan = None  # i.e. recorded before session plans were stored; physics can't be checked
+
+		if comp_track is not None:
+			comp_track.clock = self.now
+
+	def seek(self, trial_num, block_num=1):
+		"""
+		Restarts playback from the first frame of the given trial.
+		"""
+		self.__stream = FrameStream(self.db_path, self.participant_id, block_num, trial_num)
+
+	def play(self, max_frames=None):
+		"""
+		Replays frames from the current seek point (or session start), returning the divergences found.
+		"""
+		self.divergences = []
+		wall_start = None
+		rec_start = None
+		prev = None
+		late_frames = LateFrameDetector(self.late_factor)
+
+		for i, frame in enumerate(self.__stream):
+			if max_frames is not None and i >= max_frames:
+				break
+			self.__timestamp = frame.timestamp
+
+			if self.paced:
+				if wall_start is None:
+					wall_start, rec_start = time.time(), frame.timestamp
+				delay = wall_start + (frame.timestamp - rec_start) / self.speed - time.time()
+				if delay > 0:
+					time.sleep(delay)
+
+			if self.comp_track is not None:
+				self.comp_track.position = frame.target_position
+				onset = self.pvt_onset(frame.block_num, frame.trial_num)
+				onset = float('inf') if onset is None else onset
+				# the trial's state (e.g. its PVT having started) is rebuilt for each new trial, and at the start of
+				# playback or wherever time runs backwards, as either may revisit a trial already played (e.g. after seek())
+				if prev is None or onset != self.comp_track.next_trial_start_time or frame.timestamp < prev.timestamp:
+					self.comp_track.next_trial_start_time = onset
+				self.comp_track.render()
+
+			# positions are reset between trials, so only consecutive frames of a trial can be compared (trial_num
+			# restarts each block, so the block must match too)
+			if prev is not None and (prev.block_num, prev.trial_num) == (frame.block_num, frame.trial_num):
+				interval = frame.timestamp - prev.timestamp
+				if late_frames.is_late(interval):
+					self.__diverged(frame, 'late_frame', interval)
+
+				if self.plan:
+					error = abs(frame.target_position - self.expected_position(prev.target_position, frame))
+					if error > self.position_tolerance:
+						self.__diverged(frame, 'physics', error)
+			prev = frame
+
+		return self.divergences
+
+	def expected_position(self, prev_position, frame):
+		"""
+		Where CompTrack.refresh() should have moved the target from prev_position, given frame's timestamp & input.
+		"""
+		force = float(self.plan.buffeting_force(frame.timestamp))
+
+		# 'net' & 'buffeting' forces, then input
+		return clamped_step(prev_position, [force, force, frame.user_input], *self.plan.params['x_bounds'])
+
+	def pvt_onset(self, block_num, trial_num):
+		"""
+		Returns the recorded PVT onset of a trial (None if it wasn't recorded).
+		"""
+		if self.__onsets is None:
+			# one row per trial, so unlike frames this is cheap to hold
+			con = sqlite3.connect(self.db_path)
+			try:
+				rows = con.execute("SELECT `block_num`, `trial_num`, `pvt_onset` FROM `trials` WHERE `participant_id` = ?",
+								   (self.participant_id,)).fetchall()
+			finally:
+				con.close()
+			self.__onsets = {(int(b), int(t)): float(onset) for b, t, onset in rows}
+
+		return self.__onsets.get((int(block_num), int(trial_num)))
+
+	def now(self):
+		"""
+		Replay clock; stands in for klibs' now() while a recorded frame is being rendered.
+		"""
+		return self.__timestamp
+
+	def __diverged(self, frame, kind, value):
+		self.divergences.append(Divergence(frame.id, frame.block_num, frame.trial_num, kind, value))
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Headless replay of a recorded CompTrack session.")
+	parser.add_argument('db_path')
+	parser.add_argument('participant_id', type=int)
+	parser.add_argument('--speed', type=float, default=16)
+	parser.add_argument('--block', type=int, default=1)
+	parser.add_argument('--trial', type=int, default=1)
+	parser.add_argument('--paced', action='store_true', help="play back at speed x real-time rather than flat-out")
+	args = parser.parse_args()
+
+	replay = SessionReplay(args.db_path, args.participant_id, args.speed, paced=args.paced)
+	replay.seek(args.trial, args.block)
+	for d in replay.play():
+		print("frame {0} (block {1}, trial {2}): {3} {4:.6f}".format(*d))
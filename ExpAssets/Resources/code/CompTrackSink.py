@@ -0,0 +1,170 @@
+# CompTrackSink.py
+# Streams completed trials from a station to a CompTrackAggregator.
+
+# Each batch of trials is sent as one compact message: a 4-byte length prefix
+# followed by zlib-compressed JSON, with frames & assessments stored as column
+# names plus rows. The aggregator acknowledges a batch only once it's committed;
+# anything unacknowledged (e.g. the aggregator is down) is spooled to disk and
+# re-sent ahead of the next batch. A batch the aggregator can't store at all is
+# rejected, and set aside in the spool (as .rejected) so it can't hold up the rest.
+
+import json
+import os
+import socket
+import struct
+import sys
+import time
+import uuid
+import zlib
+
+FRAME_COLS = ['participant_id', 'block_num', 'trial_num', 'timestamp', 'user_input', 'target_position',
+			  'displacement', 'rt', 'flip_start_us', 'flip_end_us', 'missed_deadline']
+# mirrors CompTrackAssessment.dump()
+ASSESSMENT_COLS = ['participant_id', 'trial_num', 'block_num', 'timestamp', 'mean_rt', 'lapses', 'samples']
+
+ACK = b'OK'
+REJECT = b'NO'  # same length as ACK
+HEADER = struct.Struct('!I')
+
+
+def encode_batch(batch_id, station, frames, assessments):
+	"""
+	Packs frames (CompTrackFrame.dump() dicts) & assessments (CompTrackAssessment.dump() lists) into a message.
+	"""
+	body = {
+		'batch_id': batch_id,
+		'station': station,
+		'frames': [[f[c] for c in FRAME_COLS] for f in frames],
+		'assessments': [list(a) for a in assessments]
+	}
+	payload = zlib.compress(json.dumps(body, separators=(',', ':')).encode('utf-8'))
+
+	return HEADER.pack(len(payload)) + payload
+
+
+def decode_batch(payload):
+	return json.loads(zlib.decompress(payload).decode('utf-8'))
+
+
+def recv_exactly(sock, size):
+	chunks = []
+	while size:
+		chunk = sock.recv(size)
+		if not chunk:
+			raise socket.error("Connection closed mid-message")
+		chunks.append(chunk)
+		size -= len(chunk)
+
+	return b''.join(chunks)
+
+
+def recv_message(sock):
+	size, = HEADER.unpack(recv_exactly(sock, HEADER.size))
+
+	return recv_exactly(sock, size)
+
+
+class NetworkSink(object):
+	"""
+	Batches completed trials and pushes them to the aggregator at address, spooling to spool_dir whatever can't be
+	delivered. After a failed delivery the network isn't retried for retry_after seconds, so a downed aggregator costs
+	at most one timeout per retry_after, rather than one per trial. Between trials, at most max_batches_per_flush
+	batches are sent, so a backlog left by an outage is worked off over the following flushes rather than stalling one
+	inter-trial interval; close() sends whatever remains.
+	"""
+	def __init__(self, address, station, spool_dir, batch_trials=5, timeout=0.25, retry_after=30,
+				 max_batches_per_flush=2):
+		self.address = tuple(address)
+		self.station = station
+		self.spool_dir = spool_dir
+		self.batch_trials = batch_trials
+		self.timeout = timeout
+		self.retry_after = retry_after
+		self.max_batches_per_flush = max_batches_per_flush
+		self.pending_frames = []
+		self.pending_assessments = []
+		self.pending_trials = 0
+		self.__offline_until = 0
+
+		if not os.path.isdir(spool_dir):
+			os.makedirs(spool_dir)
+
+	def push_trial(self, frames, assessments):
+		self.pending_frames.extend(frames)
+		self.pending_assessments.extend(assessments)
+		self.pending_trials += 1
+		if self.pending_trials >= self.batch_trials:
+			self.flush(self.max_batches_per_flush)
+
+	def flush(self, max_batches=None):
+		"""
+		Spools any pending trials as a batch, then sends spooled batches, oldest first (at most max_batches of them).
+		"""
+		if self.pending_trials:
+			batch_id = "{0}-{1}".format(int(time.time() * 1000), uuid.uuid4().hex)
+			message = encode_batch(batch_id, self.station, self.pending_frames, self.pending_assessments)
+			self.pending_frames, self.pending_assessments, self.pending_trials = [], [], 0
+			# spooled first, so a crash mid-send can't lose it; the aggregator ignores batches it has already stored
+			self.__spool(batch_id, message)
+
+		if time.time() < self.__offline_until:
+			return
+
+		for path in self.spooled()[:max_batches]:
+			with open(path, 'rb') as f:
+				message = f.read()
+			reply = self.__send(message)
+			if reply == REJECT:
+				self.__quarantine(path)
+				continue
+			if reply != ACK:
+				self.__offline_until = time.time() + self.retry_after
+				return
+			os.remove(path)
+
+	def close(self):
+		self.__offline_until = 0
+		self.flush()
+
+	def spooled(self):
+		"""
+		Returns the paths of undelivered batches, oldest first.
+		"""
+		return self.__spool_files('.batch')
+
+	def rejected(self):
+		"""
+		Returns the paths of batches the aggregator refused to store, oldest first.
+		"""
+		return self.__spool_files('.rejected')
+
+	def __spool_files(self, extension):
+		names = sorted(n for n in os.listdir(self.spool_dir) if n.endswith(extension))
+
+		return [os.path.join(self.spool_dir, n) for n in names]
+
+	def __spool(self, batch_id, message):
+		path = os.path.join(self.spool_dir, batch_id + '.batch')
+		with open(path + '.tmp', 'wb') as f:
+			f.write(message)
+		os.rename(path + '.tmp', path)
+
+	def __quarantine(self, path):
+		# kept rather than deleted, so the batch can be inspected & re-sent once whatever's wrong with it is fixed
+		quarantined = os.path.splitext(path)[0] + '.rejected'
+		os.rename(path, quarantined)
+		sys.stderr.write("NetworkSink: batch rejected by aggregator, set aside as {0}\n".format(quarantined))
+
+	def __send(self, message):
+		"""
+		Returns the aggregator's reply (ACK or REJECT), or None if it couldn't be reached.
+		"""
+		try:
+			sock = socket.create_connection(self.address, self.timeout)
+			try:
+				sock.sendall(message)
+				return recv_exactly(sock, len(ACK))
+			finally:
+				sock.close()
+		except (socket.error, socket.timeout):
+			return None
@@ -0,0 +1,206 @@
+# CompTrackSweep.py
+# Offline parameter sweeps of the CompTrack cursor dynamics.
+
+# Rather than tuning via live sessions, a grid of task parameters is simulated
+# against synthetic controllers (stand-ins for participants). Each chunk of
+# configurations is advanced frame-by-frame as numpy arrays, one element per
+# configuration, and chunks are spread across a process pool.
+
+import csv
+import itertools
+import json
+from multiprocessing import Pool
+
+import numpy as np
+
+from CompTrackDynamics import buffeting_force
+
+# Mirrors ExpAssets/Config/CompensatoryTrackingTask_params.py; any key may be swept
+DEFAULTS = {
+	'max_input_step': 5,
+	'supervise_input': True,
+	'buffeting_gain': 1.0,
+	'iti': [3, 5],
+	'pvt_timeout': 1.0,
+	'reset_target_after_poll': True
+}
+
+METRICS = ['rms_error', 'mean_abs_error', 'bound_fraction', 'trials', 'lapse_rate', 'mean_rt']
+
+
+class ProportionalController(object):
+	"""
+	Synthetic participant: nudges the cursor toward screen centre in proportion to the displacement it saw delay
+	frames ago, plus motor noise. PVT reaction times are log-normal; those at or beyond the timeout are lapses.
+	"""
+	def __init__(self, name, gain=0.1, delay=12, noise_sd=1.0, rt_median=0.3, rt_sigma=0.25):
+		if delay < 1:
+			raise ValueError("Controller delay must be at least one frame.")
+		self.name = name
+		self.gain = gain
+		self.delay = delay
+		self.noise_sd = noise_sd
+		self.rt_median = rt_median
+		self.rt_sigma = rt_sigma
+
+	def input(self, seen_displacement, rng):
+		return -self.gain * seen_displacement + rng.normal(0, self.noise_sd, seen_displacement.shape)
+
+	def rt(self, rng, n):
+		return self.rt_median * np.exp(rng.normal(0, self.rt_sigma, n))
+
+
+CONTROLLERS = [
+	ProportionalController('attentive'),
+	ProportionalController('sluggish', gain=0.05, delay=24, noise_sd=2.0, rt_median=0.45, rt_sigma=0.4),
+	ProportionalController('idle', gain=0.0, noise_sd=0.0, rt_median=2.0)
+]
+
+
+def expand_grid(grid):
+	"""
+	Returns the cartesian product of grid (param name: list of values), unswept params taking DEFAULTS, as a list of
+	config dicts.
+	"""
+	unknown = set(grid) - set(DEFAULTS)
+	if unknown:
+		raise ValueError("Unknown sweep parameter(s): {0}".format(", ".join(sorted(unknown))))
+	names = sorted(DEFAULTS)
+	values = [grid.get(name, [DEFAULTS[name]]) for name in names]
+
+	return [dict(zip(names, combo)) for combo in itertools.product(*values)]
+
+
+def simulate(configs, controller, duration=500, refresh_rate=60, screen_x=1920, cursor_px=40, seed=0):
+	"""
+	Simulates a session for every config at once against one controller, returning a list of metric dicts.
+
+	Each frame follows CompTrack.refresh(): forces are applied with clamping to x_bounds, then (supervised) input;
+	the cursor isn't drawn during PVTs so the controller gives no input then, and trials last until
+	PVT onset + pvt_timeout, after which the target may be reset to centre.
+	"""
+	rng = np.random.RandomState(seed)
+	n = len(configs)
+	p = {name: np.array([c[name] for c in configs]) for name in DEFAULTS}
+	iti_min, iti_max = p['iti'][:, 0], p['iti'][:, 1]
+	supervise = p['supervise_input'].astype(bool)
+	reset = p['reset_target_after_poll'].astype(bool)
+	lo, hi = int(0.5 * cursor_px), int(screen_x - 0.5 * cursor_px)
+	centre = screen_x // 2
+	dt = 1.0 / refresh_rate
+
+	position = np.full(n, float(centre))
+	seen = np.zeros((controller.delay, n))  # ring buffer of past displacements
+	onset = rng.randint(iti_min, iti_max + 1).astype(float)
+	rt = controller.rt(rng, n)
+
+	sum_sq = np.zeros(n)
+	sum_abs = np.zeros(n)
+	at_bounds = np.zeros(n)
+	trials = np.zeros(n)
+	lapses = np.zeros(n)
+	rt_sum = np.zeros(n)
+
+	steps = int(duration * refresh_rate)
+	for i in range(steps):
+		t = i * dt
+		force = p['buffeting_gain'] * buffeting_force(t)
+
+		# refresh() applies both the 'net' and 'buffeting' forces, which are currently equal
+		position = np.clip(position + force, lo, hi)
+		position = np.clip(position + force, lo, hi)
+
+		pvt = t >= onset
+		user_input = np.where(pvt, 0.0, controller.input(seen[i % controller.delay], rng))
+		user_input = np.where(supervise, np.clip(user_input, -p['max_input_step'], p['max_input_step']), user_input)
+		position = np.clip(position + user_input, lo, hi)
+
+		displacement = position - centre
+		seen[i % controller.delay] = displacement
+		sum_sq += displacement ** 2
+		sum_abs += np.abs(displacement)
+		at_bounds += (position <= lo) | (position >= hi)
+
+		ended = t >= onset + p['pvt_timeout']
+		if ended.any():
+			lapsed = ended & (rt >= p['pvt_timeout'])
+			trials += ended
+			lapses += lapsed
+			rt_sum += np.where(ended & ~lapsed, rt, 0.0)
+			position = np.where(ended & reset, float(centre), position)
+			onset = np.where(ended, t + rng.randint(iti_min, iti_max + 1), onset)
+			rt = np.where(ended, controller.rt(rng, n), rt)
+
+	responded = trials - lapses
+	metrics = {
+		'rms_error': np.sqrt(sum_sq / steps),
+		'mean_abs_error': sum_abs / steps,
+		'bound_fraction': at_bounds / steps,
+		'trials': trials,
+		'lapse_rate': np.where(trials > 0, lapses / np.maximum(trials, 1), np.nan),
+		'mean_rt': np.where(responded > 0, rt_sum / np.maximum(responded, 1), np.nan)
+	}
+
+	return [{m: float(metrics[m][j]) for m in METRICS} for j in range(n)]
+
+
+def _simulate_chunk(args):
+	configs, controller, seed, sim_kwargs = args
+	results = simulate(configs, controller, seed=seed, **sim_kwargs)
+	for config, metrics in zip(configs, results):
+		metrics.update(config)
+		metrics['controller'] = controller.name
+
+	return results
+
+
+def run_sweep(grid, controllers=None, chunk_size=256, processes=None, seed=0, **sim_kwargs):
+	"""
+	Simulates every configuration in grid against every controller, returning one result dict per pair.
+	Chunks are seeded by position, so a sweep is reproducible regardless of process count.
+	"""
+	configs = expand_grid(grid)
+	jobs = []
+	for controller in controllers or CONTROLLERS:
+		for start in range(0, len(configs), chunk_size):
+			jobs.append((configs[start:start + chunk_size], controller, seed + len(jobs), sim_kwargs))
+
+	pool = Pool(processes)
+	try:
+		results = []
+		for chunk in pool.imap(_simulate_chunk, jobs):
+			results.extend(chunk)
+	finally:
+		pool.close()
+		pool.join()
+
+	return results
+
+
+def write_results(results, path):
+	columns = ['controller'] + sorted(DEFAULTS) + METRICS
+	with open(path, 'w') as f:
+		writer = csv.DictWriter(f, columns)
+		writer.writeheader()
+		for row in results:
+			writer.writerow(row)
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Simulate CompTrack difficulty across a parameter grid.")
+	parser.add_argument('grid', help="JSON file mapping parameter names to lists of values, e.g. {\"iti\": [[3, 5], [2, 8]]}")
+	parser.add_argument('out', help="CSV file to write per-configuration metrics to")
+	parser.add_argument('--processes', type=int, default=None)
+	parser.add_argument('--chunk-size', type=int, default=256)
+	parser.add_argument('--duration', type=float, default=500, help="simulated session length (s)")
+	parser.add_argument('--refresh-rate', type=int, default=60)
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args()
+
+	with open(args.grid) as f:
+		grid = json.load(f)
+	results = run_sweep(grid, chunk_size=args.chunk_size, processes=args.processes, seed=args.seed,
+						duration=args.duration, refresh_rate=args.refresh_rate)
+	write_results(results, args.out)
@@ -0,0 +1,308 @@
+# bench_comptrack.py
+# Micro- & macro-benchmarks of the CompTrack hot paths, with regression checks.
+
+# Runs headless (SDL dummy drivers), so needs klibs & its dependencies but no
+# display. Display & mouse I/O are stubbed out of CompTrack's module namespace,
+# so what's measured is the per-frame logic, not the graphics driver.
+#
+# Usage (from the project root):
+#   python benchmarks/bench_comptrack.py --out bench.json
+#   python benchmarks/bench_comptrack.py --out bench.json --baseline baseline.json --threshold 0.2
+#
+# Exits non-zero if any benchmark's ops/s falls more than threshold below the
+# baseline. That the kinematics fast paths agree with the per-frame update they
+# replaced is checked by tests/test_dynamics.py, which needs no klibs.
+
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+from timeit import default_timer as timer
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_DIR, 'ExpAssets', 'Resources', 'code'))
+sys.path.insert(0, PROJECT_DIR)
+
+import sdl2
+from klibs import P
+
+import CompTrack as comp_track_module
+import numpy as np
+
+from CompTrack import CompTrack, CompTrackFrame
+from CompTrackDynamics import clamped_walk
+from CompTrackPlan import SessionPlan, generate_itis
+
+SCHEMA_PATH = os.path.join(PROJECT_DIR, 'ExpAssets', 'Config', 'CompensatoryTrackingTask_schema.sql')
+PARAMS_PATH = os.path.join(PROJECT_DIR, 'ExpAssets', 'Config', 'CompensatoryTrackingTask_params.py')
+FRAME_COLS = ['participant_id', 'block_num', 'trial_num', 'timestamp', 'user_input', 'target_position',
+			  'displacement', 'rt', 'flip_start_us', 'flip_end_us', 'missed_deadline']
+
+
+class HeadlessCompTrack(CompTrack):
+	"""
+	CompTrack without the display: of CompTrack.__init__, only the non-display state it shares (see
+	CompTrack.__init_state) is initialised, so no text styles or drawbjects are created; and it never renders. Unless
+	planned is False, it's given a SessionPlan as in experiment.setup(), as every live session is.
+	"""
+	exp = type('HeadlessExperiment', (object,), {'current_frame_id': None})()
+
+	def __init__(self, planned=True):
+		# deliberately skips CompTrack.__init__
+		self._CompTrack__init_state([20, P.screen_x - 20])
+		self.timeout_after = P.pvt_timeout
+		if planned:
+			self.plan = SessionPlan(0, comp_track_module.now(), P.trials_per_block * P.blocks_per_experiment, P.iti,
+									P.pvt_timeout, P.experiment_duration, self.x_bounds)
+		self.next_trial_start_time = float('inf')  # i.e. an ITI lasting the whole benchmark
+
+	def _CompTrack__render(self):
+		pass
+
+
+def configure_params():
+	# the project's parameters, as klibs would load them, then those klibs would derive from the display & session
+	params = {}
+	with open(PARAMS_PATH) as f:
+		exec(f.read(), params)
+	for name, value in params.items():
+		if not name.startswith('__'):
+			setattr(P, name, value)
+	P.screen_x, P.screen_y = 1920, 1080
+	P.screen_c = (960, 540)
+	P.participant_id = 1
+	P.block_number = 1
+	P.trial_number = 1
+
+	# mouse warping needs a window, which headless runs don't have
+	comp_track_module.mouse_pos = lambda *args, **kwargs: None
+
+
+def motion_events(count, seed=0):
+	rng = random.Random(seed)
+	queue = []
+	for i in range(count):
+		e = sdl2.SDL_Event()
+		e.type = sdl2.SDL_MOUSEMOTION
+		e.motion.xrel = rng.randint(-20, 20)
+		queue.append(e)
+
+	return queue
+
+
+def bench_refresh(n):
+	ct = HeadlessCompTrack()
+	events = motion_events(4)
+	def run():
+		ct.frames = []
+		for i in range(n):
+			ct.refresh(events)
+	return run
+
+
+def bench_buffeting_force(n, planned=True):
+	ct = HeadlessCompTrack(planned)
+	ct.frames = [[CompTrackFrame(None, 1000.0)]]
+	force = ct._CompTrack__buffeting_force
+	def run():
+		for i in range(n):
+			force()
+	return run
+
+
+def bench_buffeting_force_unplanned(n):
+	# the plan-less fallback, i.e. the path before session plans; for comparison only
+	return bench_buffeting_force(n, planned=False)
+
+
+def bench_position_setter(n):
+	ct = HeadlessCompTrack()
+	values = [-100.0, 20.5, 960.0, 1899.5, 2500.0] * (n // 5 + 1)
+	values = values[:n]
+	def run():
+		for v in values:
+			ct.position = v
+	return run
+
+
+def bench_capture_mouse_input(n):
+	# n events in a single queue, i.e. one very busy frame
+	ct = HeadlessCompTrack()
+	ct.frames = [[CompTrackFrame(None, 1000.0)]]
+	events = motion_events(n)
+	capture = ct._CompTrack__capture_mouse_input
+	def run():
+		ct.current_frame.user_input = None
+		capture(events)
+	return run
+
+
+def bench_frame_dump(n):
+	frames = [CompTrackFrame(None, 1000.0 + i / 60.0) for i in range(n)]
+	def run():
+		for f in frames:
+			f.dump()
+	return run
+
+
+def bench_generate_itis(n):
+	# just long enough to pass generate_itis()'s feasibility checks
+	duration = int(n * (0.5 * P.pvt_timeout + 0.5 * sum(P.iti))) + 1
+	def run():
+		generate_itis(random.Random(0), n, P.iti, P.pvt_timeout, duration)
+	return run
+
+
+def bench_clamped_walk(n):
+	steps = np.random.RandomState(0).normal(0, 3, n)
+	def run():
+		clamped_walk(960.0, steps, 20, 1900)
+	return run
+
+
+def frame_row(frame):
+	data = frame.dump()
+	return [data[c] for c in FRAME_COLS]
+
+
+def empty_db():
+	# a fresh database of the project's schema; returns its path
+	with open(SCHEMA_PATH) as f:
+		schema = f.read()
+	fd, path = tempfile.mkstemp(suffix='.db')
+	os.close(fd)
+	con = sqlite3.connect(path)
+	con.executescript(schema)
+	con.close()
+
+	return path
+
+
+def bench_db_clean_up_frames(n):
+	# the path experiment.clean_up() takes: one klibs Database.insert() (i.e. an INSERT & a commit) per frame
+	from klibs.KLDatabase import Database
+	frames = [CompTrackFrame(None, 1000.0 + i / 60.0) for i in range(n)]
+	def run():
+		path = empty_db()
+		try:
+			db = Database(path)
+			for f in frames:
+				db.insert(f.dump(), 'frames')
+			db.close()
+		finally:
+			os.remove(path)
+	return run
+
+
+def bench_sqlite_executemany_frames(n):
+	# NOT clean_up()'s path: the same rows in one bulk insert & transaction, i.e. the floor clean_up() could reach
+	frames = [CompTrackFrame(None, 1000.0 + i / 60.0) for i in range(n)]
+	query = "INSERT INTO `frames` ({0}) VALUES ({1})".format(", ".join(FRAME_COLS), ", ".join("?" * len(FRAME_COLS)))
+	def run():
+		path = empty_db()
+		try:
+			con = sqlite3.connect(path)
+			with con:
+				con.executemany(query, (frame_row(f) for f in frames))
+			con.close()
+		finally:
+			os.remove(path)
+	return run
+
+
+# name: (benchmark factory, op count per run)
+BENCHMARKS = [
+	('refresh', bench_refresh, 10000),
+	('buffeting_force', bench_buffeting_force, 100000),
+	('buffeting_force_unplanned', bench_buffeting_force_unplanned, 100000),
+	('position_setter', bench_position_setter, 100000),
+	('clamped_walk_100k_steps', bench_clamped_walk, 100000),
+	('capture_mouse_input_10k_events', bench_capture_mouse_input, 10000),
+	('frame_dump', bench_frame_dump, 100000),
+	('generate_itis_1k_trials', bench_generate_itis, 1000),
+	('generate_itis_10k_trials', bench_generate_itis, 10000),
+	('db_clean_up_10k_frames', bench_db_clean_up_frames, 10000),
+	('db_clean_up_100k_frames', bench_db_clean_up_frames, 100000),
+	('db_clean_up_1m_frames', bench_db_clean_up_frames, 1000000),
+	('sqlite_executemany_10k_frames', bench_sqlite_executemany_frames, 10000),
+	('sqlite_executemany_100k_frames', bench_sqlite_executemany_frames, 100000),
+	('sqlite_executemany_1m_frames', bench_sqlite_executemany_frames, 1000000),
+]
+
+
+def run_benchmarks(names=None, repeat=5, quick=False):
+	results = {}
+	for name, factory, ops in BENCHMARKS:
+		if names and name not in names:
+			continue
+		if quick and ops > 100000:
+			continue
+		run = factory(ops)
+		best = None
+		for i in range(1 if quick else repeat):
+			start = timer()
+			run()
+			elapsed = timer() - start
+			best = elapsed if best is None else min(best, elapsed)
+		results[name] = {'ops': ops, 'seconds': best, 'ops_per_sec': ops / best}
+		print("{0:<34} {1:>14,.0f} ops/s  ({2:.4f}s best of {3})".format(name, ops / best, best, 1 if quick else repeat))
+
+	return results
+
+
+def regressions(results, baseline, threshold):
+	"""
+	Returns (name, baseline ops/s, current ops/s) for each benchmark slower than baseline by more than threshold.
+	"""
+	slower = []
+	for name, result in sorted(results.items()):
+		try:
+			expected = baseline['benchmarks'][name]['ops_per_sec']
+		except KeyError:
+			continue  # new benchmark
+		if result['ops_per_sec'] < expected * (1 - threshold):
+			slower.append((name, expected, result['ops_per_sec']))
+
+	return slower
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark the CompTrack hot paths.")
+	parser.add_argument('--out', help="write results to this JSON file")
+	parser.add_argument('--baseline', help="JSON file of a previous run to compare against")
+	parser.add_argument('--threshold', type=float, default=0.2, help="tolerated fractional slow-down vs. baseline")
+	parser.add_argument('--repeat', type=int, default=5)
+	parser.add_argument('--quick', action='store_true', help="single repetition, skip benchmarks of over 100k ops")
+	parser.add_argument('names', nargs='*', help="run only these benchmarks")
+	args = parser.parse_args()
+
+	configure_params()
+	results = run_benchmarks(args.names, args.repeat, args.quick)
+	report = {
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'benchmarks': results
+	}
+	if args.out:
+		with open(args.out, 'w') as f:
+			json.dump(report, f, indent=2, sort_keys=True)
+
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		slower = regressions(results, baseline, args.threshold)
+		for name, expected, actual in slower:
+			print("REGRESSION {0}: {1:,.0f} ops/s vs. baseline {2:,.0f}".format(name, actual, expected))
+		if slower:
+			sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
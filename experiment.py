@@ -2,7 +2,6 @@
 
 __author__ = "Brett Feltmate"
 from sdl2 import SDL_GetKeyFromName, SDL_KEYDOWN, SDL_KEYUP, SDL_MOUSEBUTTONDOWN, SDL_MOUSEBUTTONUP, SDLK_SPACE
-import random
 import klibs
 from klibs import P
 from klibs.KLUserInterface import ui_request
@@ -16,8 +15,8 @@ from klibs.KLResponseCollectors import Response, KeyPressResponse
 import sdl2
 from klibs.KLGraphics.KLNumpySurface import *
 from CompTrack import *
+from CompTrackPlan import SessionPlan
 import klibs.KLDatabase
-import subprocess
 
 from klibs.KLDatabase import EntryTemplate
 
@@ -40,8 +39,22 @@ class CompensatoryTrackingTask(klibs.Experiment):
 		# CompTrack class handles all events
 		self.comp_track = CompTrack()
 		self.comp_track.timeout_after = P.pvt_timeout
+
+		# fix the session's ITIs, disturbance & mitigations from its seed, storing just what's needed to regenerate them
+		self.comp_track.check_mitigations(P.planned_mitigation_types)
+		self.plan = SessionPlan(P.random_seed, now(), P.trials_per_block * P.blocks_per_experiment, P.iti,
+								P.pvt_timeout, P.experiment_duration, self.comp_track.x_bounds,
+								P.planned_mitigation_rate, P.planned_mitigation_types)
+		self.comp_track.plan = self.plan
+		self.db.insert({'participant_id': P.participant_id, 'plan': self.plan.encode()}, 'session_plans')
 		self.generate_ITIs()
 
+		# render everything up front so the first trial's frames are as quick as the rest
+		startup_times = self.comp_track.warm_up()
+		if P.development_mode:
+			for stage, duration in startup_times.items():
+				print("CompTrack start-up, {0}: {1:.1f}ms".format(stage, duration * 1000))
+
 
 		# Ensure mouse starts at centre and set invisible
 		mouse_pos(False, P.screen_c)
@@ -55,7 +68,13 @@ class CompensatoryTrackingTask(klibs.Experiment):
 		pass
 
 	def trial_prep(self):
-		self.comp_track.next_trial_start_time = now() + self.itis.pop()
+		self.comp_track.prepare_trial(now() + self.itis.pop(0))
+
+		# trial_index counts trials across blocks, as do the plan's ITIs & mitigations
+		planned_mitigation = self.plan.mitigations.get(self.comp_track.trial_index)
+		if planned_mitigation:
+			self.comp_track.mitigate(planned_mitigation)
+
 		self.start = now()
 		pump()
 
@@ -63,11 +82,12 @@ class CompensatoryTrackingTask(klibs.Experiment):
 		start = now()
 		rt = -1
 
-		while now() < self.comp_track.next_trial_start_time + P.pvt_timeout:
+		trial_state = self.comp_track.trial_state  # advanced by each refresh
+		while not trial_state.complete:
 			event_q = pump(True)
 			ui_request(None, True, event_q)
 			self.comp_track.refresh(event_q)
-			if now() >= self.comp_track.next_trial_start_time:
+			if trial_state.pvt_active:
 				for event in event_q:
 					if event.type == SDL_KEYDOWN and event.key.keysym == SDLK_SPACE:
 						key = event.key.keysym # keyboard button event object
@@ -78,27 +98,42 @@ class CompensatoryTrackingTask(klibs.Experiment):
 		if not rt:
 			# here's where we could  add feedback immediately after a lapse, were it desired
 			pass
+		pvt_onset = self.comp_track.next_trial_start_time  # cleared by end_trial()
 		self.comp_track.end_trial(rt)
 
-		return {'block_num': P.block_number,
+		trial_data = {'block_num': P.block_number,
 				'trial_num' : P.trial_number,
 				'timestamp': self.comp_track.current_frame.timestamp,
+				'pvt_onset': pvt_onset,
 				'rt': self.comp_track.current_frame.rt
 		}
+		# dropped frames, worst & estimated refresh intervals; for excluding trials with unreliable presentation
+		trial_data.update(self.comp_track.trial_timing)
+
+		return trial_data
 
 	def trial_clean_up(self):
 		pass
 
 	def clean_up(self):
+		if self.comp_track.sink:
+			self.comp_track.sink.close()
+
 		for a in self.comp_track.assessments:
 			self.db.insert(a.dump(), 'assessments')
 
+		# if P.max_trials_in_memory is set, older trials are read back from their on-disk archives one at a time
 		for trial in self.comp_track.frames:
 			for f in trial:
 				self.db.insert(f.dump(), 'frames')
 
+		if P.max_trials_in_memory:
+			self.comp_track.frames.discard()
+			self.comp_track.assessments.discard()
+
 
 	def check_osx_mouse_shake_setting(self):
+		import subprocess
 		p = subprocess.Popen(
 		"defaults read ~/Library/Preferences/.GlobalPreferences CGDisableCursorLocationMagnification 1", shell=True)
 
@@ -113,26 +148,8 @@ class CompensatoryTrackingTask(klibs.Experiment):
 			quit()
 
 	def generate_ITIs(self):
-
-		trial_count = P.trials_per_block * P.blocks_per_experiment
-		expected_duration = (0.5 * trial_count * P.pvt_timeout) + ( trial_count * sum(P.iti) * 0.5)
-
-		if expected_duration > P.experiment_duration:
-			raise ValueError("It is unlikely this number of trials, of the proposed ITIs, can be completed in the allotted time.")
-
-		# start with a uniform block of minimum itis
-		self.itis = P.trials_per_block * P.blocks_per_experiment * [P.iti[0]]
-
-		surplus = P.experiment_duration - sum(self.itis)
-
-		if surplus > P.trials_per_block * P.blocks_per_experiment * [P.iti[1]]:
-			raise ValueError("This experiment duration cannot be met with this trial count/ITI combination.")
-		while surplus > 0:
-			index = random.randint(0,len(self.itis) -1)
-			if self.itis[index] < P.iti[1]:
-				self.itis[index] += 1
-				surplus -= 1
-			surplus = P.experiment_duration - sum(self.itis)
+		# drawn from the session's seed; see CompTrackPlan.generate_itis()
+		self.itis = list(self.plan.itis)
 
 	@property
 	def event_queue(self):
@@ -0,0 +1,122 @@
+# test_dynamics.py
+# Checks the cursor physics fast paths against the per-frame update they replaced.
+
+# Needs only numpy (CompTrackDynamics & CompTrackPlan are free of klibs & SDL):
+#   python -m pytest tests
+
+import os
+import random
+import sys
+
+import numpy as np
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_DIR, 'ExpAssets', 'Resources', 'code'))
+
+from CompTrackDynamics import clamped_step, clamped_walk
+from CompTrackPlan import SessionPlan
+
+TOLERANCE = 1e-9
+
+
+def legacy_position(val, x_bounds):
+	# the position setter before clamped_step() was introduced; the reference for check_kinematics()
+	if int(val) not in range(*x_bounds):
+		if val < x_bounds[0]:
+			val = x_bounds[0]
+		else:
+			val = x_bounds[1]
+
+	return val
+
+
+def legacy_refresh_position(position, forces, user_input, x_bounds):
+	for force in ['net', 'additional', 'buffeting']:
+		try:
+			position = legacy_position(position + forces[force], x_bounds)
+		except TypeError:
+			pass
+
+	return legacy_position(position + user_input, x_bounds)
+
+
+def check_kinematics(frames=5000, seed=0):
+	"""
+	Returns the largest disagreement between the legacy per-frame position update and clamped_step() & clamped_walk()
+	over a run of synthetic frames that often pin the cursor against either bound.
+	"""
+	rng = random.Random(seed)
+	x_bounds = [20, 1900]
+	position = step_position = 960.0
+	legacy, steps, frame_ends = [], [], []
+	worst = 0.0
+	for i in range(frames):
+		buffeting = rng.gauss(0, 3)
+		forces = {'net': buffeting, 'additional': rng.choice([None, rng.gauss(0, 1)]), 'buffeting': buffeting}
+		user_input = float(rng.choice([rng.randint(-5, 5), rng.randint(-400, 400)]))
+
+		position = legacy_refresh_position(position, forces, user_input, x_bounds)
+		step_position = clamped_step(step_position, [forces['net'], forces['additional'], forces['buffeting'],
+													 user_input], *x_bounds)
+		worst = max(worst, abs(position - step_position))
+
+		legacy.append(position)
+		steps.extend(s for s in [forces['net'], forces['additional'], forces['buffeting'], user_input] if s is not None)
+		frame_ends.append(len(steps) - 1)
+
+	walked = clamped_walk(960.0, steps, *x_bounds)[frame_ends]
+
+	return max(worst, float(np.max(np.abs(walked - np.array(legacy)))))
+
+
+def stepwise_walk(position, steps, lo, hi):
+	# clamped_walk()'s reference: every position clamped_step() reaches, one step at a time
+	positions = []
+	for step in steps:
+		position = clamped_step(position, [step], lo, hi)
+		positions.append(position)
+
+	return positions
+
+
+def test_fast_paths_match_legacy_update():
+	for seed in range(3):
+		assert check_kinematics(seed=seed) < TOLERANCE
+
+
+def test_walk_columns_with_own_bounds():
+	# one column per simulated configuration, each clamped to its own bounds
+	steps = np.random.RandomState(0).normal(0, 40, (500, 3))
+	lo = np.array([0.0, 100.0, 450.0])
+	hi = np.array([1000.0, 600.0, 550.0])
+	walked = clamped_walk(500.0, steps, lo, hi)
+
+	assert walked.shape == steps.shape
+	for col in range(steps.shape[1]):
+		expected = stepwise_walk(500.0, steps[:, col], lo[col], hi[col])
+		assert np.max(np.abs(walked[:, col] - expected)) < TOLERANCE
+
+
+def test_walk_empty_and_single_step():
+	assert clamped_walk(5.0, [], 0, 10).shape == (0,)
+	assert clamped_walk(5.0, np.empty((0, 2)), 0, 10).shape == (0, 2)
+	assert list(clamped_walk(5.0, [3.0], 0, 10)) == [8.0]
+	assert list(clamped_walk(5.0, [30.0], 0, 10)) == [10.0]
+	assert list(clamped_walk(5.0, [-30.0], 0, 10)) == [0.0]
+
+
+def test_plan_positions_match_refresh_steps():
+	plan = SessionPlan(7, 1000.0, 20, [3, 5], 1.0, 100, [20, 1900])
+	rng = random.Random(1)
+	timestamps = [1000.0 + i / 60.0 for i in range(600)]
+	user_inputs = [float(rng.choice([rng.randint(-5, 5), rng.randint(-900, 900)])) for t in timestamps]
+
+	# per frame, as CompTrack.refresh() applies them: 'net' & 'buffeting' forces (equal), then input
+	position = 960.0
+	expected = []
+	for t, user_input in zip(timestamps, user_inputs):
+		force = float(plan.buffeting_force(t))
+		position = clamped_step(position, [force, force, user_input], 20, 1900)
+		expected.append(position)
+
+	assert np.max(np.abs(plan.positions(960.0, timestamps, user_inputs) - expected)) < TOLERANCE